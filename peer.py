@@ -1,20 +1,192 @@
 # Written by Samuel Sjøen
 # Based on skeleton code provided by Daniel Hernandez Escobar
 
-from os import environ, listdir
-from selectors import EVENT_READ, DefaultSelector
-from socket import create_connection, create_server, socket
+from collections import deque
+from collections.abc import Callable
+from errno import EOPNOTSUPP
+from mmap import mmap
+import os
+from os import O_RDONLY, close, environ, fstat, ftruncate, listdir, remove, sendfile
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import (
+    IPPROTO_TCP,
+    SOCK_STREAM,
+    TCP_NODELAY,
+    create_connection,
+    create_server,
+    getaddrinfo,
+    socket,
+)
+from stat import S_ISREG
 import sys
 from threading import Thread
 
+try:
+    from socket import MSG_FASTOPEN, TCP_FASTOPEN
+except ImportError:  # TCP Fast Open is only available on Linux
+    MSG_FASTOPEN = TCP_FASTOPEN = None
+
 PEER = environ.get("PEER", "localhost")
 TRACKER = environ.get("TRACKER", "localhost")
 FOLDER = environ.get("FOLDER", "Files")
 
+# Names of the files in FOLDER, kept up to date as files are downloaded
+LOCAL_FILES: set[str] = set(listdir(FOLDER))
+
+# Only Linux can skip updating the access time of the files we serve
+O_NOATIME = getattr(os, "O_NOATIME", 0)
+
+CHUNK_SIZE = 65536
+# Largest message accepted, well above the size of a real ADD_MANY
+MAX_MESSAGE_SIZE = 4 << 20
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
 selector = DefaultSelector()
 
 
-def remote_call(sock: socket, message: bytes) -> bytes:
+class Connection:
+    """
+    Keeps the bytes received on a connection until a whole request has arrived,
+    and the replies and file still to be sent back on it.
+
+    Every message is framed as a 4-byte big-endian length followed by the payload.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.received = 0
+        self.pending: deque[bytes] = deque()
+        self.outbuf = bytearray()
+        self.fd: int | None = None
+        self.offset = 0
+        self.size = 0
+
+    def receive(self, conn: socket) -> bool:
+        """Reads the available bytes from conn, returns False if it was closed."""
+        end = self.received + CHUNK_SIZE
+        n = conn.recv_into(memoryview(self.buffer)[self.received : end])
+        self.received += n
+        return n > 0
+
+    def requests(self) -> list[bytes]:
+        """
+        Returns the complete requests in the buffer and removes them from it.
+
+        Raises ConnectionError when a request is larger than MAX_MESSAGE_SIZE.
+        """
+        requests = []
+        start = 0
+        while self.received - start >= 4:
+            end = start + 4 + int.from_bytes(self.buffer[start : start + 4], "big")
+            if end > self.received:
+                break
+            requests.append(bytes(self.buffer[start + 4 : end]))
+            start = end
+        if start:
+            # Move the unfinished request to the front, unless it is already there
+            self.buffer[: self.received - start] = self.buffer[start : self.received]
+            self.received -= start
+            if self.received <= CHUNK_SIZE < len(self.buffer):
+                # Give back the room made for an earlier large request
+                del self.buffer[CHUNK_SIZE:]
+        if self.received >= 4:
+            # Make room for the rest of a request larger than the buffer
+            needed = 4 + int.from_bytes(self.buffer[:4], "big")
+            if needed > 4 + MAX_MESSAGE_SIZE:
+                raise ConnectionError("Message too large")
+            if needed > len(self.buffer):
+                self.buffer.extend(bytes(needed - len(self.buffer)))
+        return requests
+
+
+def frame(message: bytes) -> bytes:
+    """Prefixes a message with its length."""
+    return len(message).to_bytes(4, "big") + message
+
+
+def tune(sock: socket) -> None:
+    """
+    Disables Nagle's algorithm on a socket.
+
+    The kernel buffer sizes are left alone: setting them turns off Linux's
+    buffer autotuning, which grows them further than an explicit size can.
+    """
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+
+def receive_exactly(
+    sock: socket, view: memoryview, chunk_size: int = CHUNK_SIZE
+) -> None:
+    """
+    Fills view with bytes read from a socket.
+
+    Parameters
+    ----------
+    sock: socket
+        A socket object to read from.
+    view: memoryview
+        A writable memoryview of the buffer to fill.
+    chunk_size: int
+        The largest number of bytes to read in one call.
+    """
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received : received + chunk_size])
+        if not n:
+            raise ConnectionError("Connection closed before the message was complete")
+        received += n
+
+
+def receive_message(sock: socket) -> bytearray:
+    """Reads one length-prefixed message from a socket."""
+    header = bytearray(4)
+    receive_exactly(sock, memoryview(header))
+    size = int.from_bytes(header, "big")
+    if size > MAX_MESSAGE_SIZE:
+        raise ConnectionError("Message too large")
+    message = bytearray(size)
+    receive_exactly(sock, memoryview(message))
+    return message
+
+
+def receive_reply(sock: socket) -> tuple[bytes, bytes]:
+    """
+    Reads one length-prefixed reply from a socket, together with the bytes that
+    followed it in the same reads.
+
+    Reading into one large buffer usually gets the reply and the start of the
+    data that comes after it with a single call.
+
+    Parameters
+    ----------
+    sock: socket
+        A socket object to read from.
+
+    Returns
+    -------
+    reply: bytes
+        The payload of the reply.
+    rest: bytes
+        The bytes received after the reply.
+    """
+    buffer = bytearray(CHUNK_SIZE)
+    received = 0
+    end = 4
+    while received < end:
+        n = sock.recv_into(memoryview(buffer)[received:])
+        if not n:
+            raise ConnectionError("Connection closed before the message was complete")
+        received += n
+        if received >= 4:
+            end = 4 + int.from_bytes(buffer[:4], "big")
+            if end > 4 + MAX_MESSAGE_SIZE:
+                raise ConnectionError("Message too large")
+            if end > len(buffer):
+                buffer.extend(bytes(end - len(buffer)))
+    return bytes(buffer[4:end]), bytes(buffer[end:received])
+
+
+def remote_call(sock: socket, message: bytes) -> bytearray:
     """
     Sends a message to a socket and returns the response from the socket.
 
@@ -27,15 +199,79 @@ def remote_call(sock: socket, message: bytes) -> bytes:
 
     Returns
     -------
-    answer : bytes
+    answer : bytearray
         The response to message we sent
     """
-    sock.sendall(message)
-    answer = sock.recv(1024)
+    sock.sendall(frame(message))
+    answer = receive_message(sock)
     return answer
 
 
-def serve_peer(data: bytes) -> bytes:
+def open_file(path: str) -> int:
+    """
+    Opens a file for reading, without updating its access time where permitted.
+
+    Parameters
+    ----------
+    path: str
+        A string representing the path of the file.
+
+    Returns
+    -------
+    fd: int
+        The file descriptor of the opened file.
+    """
+    try:
+        return os.open(path, O_RDONLY | O_NOATIME)
+    except PermissionError:
+        # O_NOATIME is only allowed on files owned by the user running the peer
+        if not O_NOATIME:
+            raise
+        return os.open(path, O_RDONLY)
+
+
+def serve_get_file(name: bytes) -> tuple[bytes, int | None, int]:
+    """
+    Opens a local file to stream to a peer.
+
+    Parameters
+    ----------
+    name: bytes
+        A byte object representing the name of the requested file.
+
+    Returns
+    -------
+    The reply header, the file descriptor to stream and the number of bytes to
+    stream, as returned by serve_peer.
+    """
+
+    try:
+        fd = open_file(FOLDER + "/" + name.decode())
+    except PermissionError:
+        return b"BAD File is not readable", None, 0
+    except (OSError, ValueError):
+        # Names that are not UTF-8, hold a null byte or do not name a file in
+        # FOLDER, such as "a.txt/b" or a name that is too long
+        return b"BAD File does not exist", None, 0
+    status = fstat(fd)
+    if not S_ISREG(status.st_mode):
+        # Unlike open(), os.open() also succeeds on directories
+        close(fd)
+        return b"BAD File does not exist", None, 0
+    return b"OK " + str(status.st_size).encode(), fd, status.st_size
+
+
+def serve_unsupported(_: bytes) -> tuple[bytes, int | None, int]:
+    """Replies to a request with an unknown method."""
+    return b"BAD Method not supported", None, 0
+
+
+HANDLERS: dict[bytes, Callable[[bytes], tuple[bytes, int | None, int]]] = {
+    b"GET_FILE": serve_get_file,
+}
+
+
+def serve_peer(data: bytes) -> tuple[bytes, int | None, int]:
     """
     Processes a request from a peer and returns a response.
 
@@ -47,24 +283,22 @@ def serve_peer(data: bytes) -> bytes:
     Returns
     -------
     reply: bytes
-        A byte object with the response to the given request.
+        A byte object with the header of the response to the given request.
+    fd: int | None
+        The file descriptor of the file to stream after the header, or None if there
+        is none.
+    size: int
+        The number of bytes to stream from fd.
     """
 
-    match data.split(b" ", 1):
-        case [b"GET_FILE", file]:
-            try:
-                with open(FOLDER + "/" + file.decode(), "rb") as f:
-                    content = f.read()
-            except FileNotFoundError:
-                reply = b"BAD File does not exist"
-            else:
-                reply = b"OK " + content
-        case _:
-            reply = b"BAD Method not supported"
-    return reply
+    method, _, argument = data.partition(b" ")
+    if not argument:
+        # GET_FILE needs the name of a file
+        return serve_unsupported(argument)
+    return HANDLERS.get(method, serve_unsupported)(argument)
 
 
-def read_peer(conn: socket) -> None:
+def read_peer(conn: socket, state: Connection) -> None:
     """
     Reads data from a peer's connection and returns the response
 
@@ -72,15 +306,94 @@ def read_peer(conn: socket) -> None:
     ----------
     conn: socket
        A socket object representing the connection to the peer
+    state: Connection
+       The state of the connection
     """
 
-    data = conn.recv(1024)
-    if data:
-        reply = serve_peer(data.strip())
-        conn.sendall(reply)
+    try:
+        received = state.receive(conn)
+        requests = state.requests() if received else []
+    except BlockingIOError:
+        return
+    except OSError:
+        received = False
+    if received:
+        state.pending.extend(requests)
+        serve_pending(state)
+        write_peer(conn, state)
     else:
-        selector.unregister(conn)
-        conn.close()
+        close_peer(conn, state)
+
+
+def serve_pending(state: Connection) -> None:
+    """
+    Queues the replies to the buffered requests of a peer, until one of them starts
+    streaming a file. The rest are answered once the file has been sent.
+
+    Parameters
+    ----------
+    state: Connection
+       The state of the connection
+    """
+
+    while state.fd is None and state.pending:
+        reply, fd, size = serve_peer(state.pending.popleft())
+        state.outbuf += frame(reply)
+        if fd is not None:
+            state.fd, state.offset, state.size = fd, 0, size
+
+
+def write_peer(conn: socket, state: Connection) -> None:
+    """
+    Sends as much of the queued replies and the streamed file as the socket accepts.
+
+    The connection waits for the socket to become writable only while there is
+    something left to send, so a slow peer does not hold up the others.
+
+    Parameters
+    ----------
+    conn: socket
+       A socket object representing the connection to the peer
+    state: Connection
+       The state of the connection
+    """
+
+    try:
+        while state.outbuf or state.fd is not None:
+            if state.outbuf:
+                sent = conn.send(state.outbuf)
+                del state.outbuf[:sent]
+                continue
+            remaining = state.size - state.offset
+            sent = sendfile(conn.fileno(), state.fd, state.offset, remaining)
+            state.offset += sent
+            if state.offset >= state.size:
+                close(state.fd)
+                state.fd = None
+                serve_pending(state)
+            elif sent == 0:
+                # The file shrank after its size was sent, so the peer would wait
+                # forever for the rest of it
+                close_peer(conn, state)
+                return
+    except BlockingIOError:
+        pass
+    except OSError:
+        close_peer(conn, state)
+        return
+    events = EVENT_READ
+    if state.outbuf or state.fd is not None:
+        events |= EVENT_WRITE
+    if selector.get_key(conn).events != events:
+        selector.modify(conn, events, state)
+
+
+def close_peer(conn: socket, state: Connection) -> None:
+    """Unregisters and closes the connection to a peer."""
+    selector.unregister(conn)
+    if state.fd is not None:
+        close(state.fd)
+    conn.close()
 
 
 def accept_peer(sock: socket) -> None:
@@ -93,23 +406,40 @@ def accept_peer(sock: socket) -> None:
         A socket object representing the incoming socket
     """
     conn, addr = sock.accept()
+    tune(conn)
     conn.setblocking(False)
-    selector.register(conn, EVENT_READ, read_peer)
+    selector.register(conn, EVENT_READ, Connection())
 
 
-def serve_peer_thread() -> None:
+def listen_for_peers() -> None:
     """
-    Starts a thread to listen for and process request from peers using selectors.
+    Opens the socket peers connect to and registers it with the selector.
     """
 
     sock = create_server((PEER, 12010))
+    tune(sock)
+    if TCP_FASTOPEN is not None:
+        # Accept requests carried in the SYN, queueing at most 5 handshakes
+        sock.setsockopt(IPPROTO_TCP, TCP_FASTOPEN, 5)
     sock.setblocking(False)
-    selector.register(sock, EVENT_READ, accept_peer)
+    selector.register(sock, EVENT_READ)
+
+
+def serve_peer_thread() -> None:
+    """
+    Processes requests from peers using selectors, to be run in its own thread.
+    """
 
     while True:
         events = selector.select()
-        for key, _ in events:
-            key.data(key.fileobj)
+        for key, mask in events:
+            if key.data is None:
+                accept_peer(key.fileobj)
+            elif mask & EVENT_READ:
+                # Also sends whatever the new requests queued
+                read_peer(key.fileobj, key.data)
+            else:
+                write_peer(key.fileobj, key.data)
 
 
 def add_from_peer(tracker_sock: socket, file: str) -> None:
@@ -127,6 +457,34 @@ def add_from_peer(tracker_sock: socket, file: str) -> None:
     remote_call(tracker_sock, add_file.encode())
 
 
+def send_local_files(tracker_sock: socket, method: bytes) -> None:
+    """
+    Sends the names of all local files to the tracker in ADD_MANY or REMOVE_MANY
+    requests, using as many requests as needed to keep each within
+    MAX_MESSAGE_SIZE.
+
+    Parameters
+    ----------
+    tracker_sock: socket
+        A socket representing the connection to the tracker.
+    method: bytes
+        A byte object representing the method of the requests.
+    """
+    # The names are separated by slashes, which unlike "; " cannot be part of one
+    batch: list[bytes] = []
+    size = len(method)
+    for file in LOCAL_FILES:
+        name = file.encode()
+        if batch and size + 1 + len(name) > MAX_MESSAGE_SIZE:
+            remote_call(tracker_sock, method + b" " + b"/".join(batch))
+            batch = []
+            size = len(method)
+        batch.append(name)
+        size += 1 + len(name)
+    if batch:
+        remote_call(tracker_sock, method + b" " + b"/".join(batch))
+
+
 def connect_to_tracker(address: tuple[str, int]) -> socket:
     """
     Connects to the tracker and adds all local files to its database.
@@ -142,8 +500,8 @@ def connect_to_tracker(address: tuple[str, int]) -> socket:
         A socket representing the connection to the tracker.
     """
     tracker_sock = create_connection(address, source_address=(PEER, 0))
-    for file in listdir(FOLDER):
-        add_from_peer(tracker_sock, file)
+    tune(tracker_sock)
+    send_local_files(tracker_sock, b"ADD_MANY")
     return tracker_sock
 
 
@@ -156,12 +514,11 @@ def disconnect_from_tracker(tracker_sock: socket) -> None:
     trakcer_sock: socket
         A socket representing the connection to the tracker.
     """
-    for file in listdir(FOLDER):
-        remote_call(tracker_sock, b"REMOVE " + file.encode())
+    send_local_files(tracker_sock, b"REMOVE_MANY")
     tracker_sock.close()
 
 
-def list_files(tracker_sock: socket) -> list[str]:
+def list_files(tracker_sock: socket) -> list[str] | None:
     """
     Sends a request to the tracker to list all available files.
 
@@ -172,14 +529,16 @@ def list_files(tracker_sock: socket) -> list[str]:
 
     Returns
     -------
-    list_of_files: list[str]
-        A list of files available but not in local files.
+    list_of_files: list[str] | None
+        A list of files available but not in local files, or None if the tracker
+        could not list them.
     """
-    _, data = remote_call(tracker_sock, b"LIST_FILES").split(b" ", 1)
+    status, data = remote_call(tracker_sock, b"LIST_FILES").split(b" ", 1)
+    if status == b"BAD":
+        return None
     decoded_data = data.decode()
     remote_files = decoded_data.split("; ")
-    local_files = listdir(FOLDER)
-    return [file for file in remote_files if file not in local_files]
+    return [file for file in remote_files if file not in LOCAL_FILES]
 
 
 def get_peer(tracker_sock: socket, file: str) -> str:
@@ -210,6 +569,77 @@ def get_peer(tracker_sock: socket, file: str) -> str:
             return None
 
 
+def allocate(fd: int, size: int) -> None:
+    """Grows the file behind fd to size bytes, reserving the disk space if possible."""
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        ftruncate(fd, size)
+
+
+def receive_file(sock: socket, path: str, size: int, start: bytes = b"") -> None:
+    """
+    Receives a file from a socket straight into a memory map of the file on disk.
+
+    Parameters
+    ----------
+    sock: socket
+        A socket object to read the content of the file from.
+    path: str
+        A string representing the path to save the file to.
+    size: int
+        The size of the file in bytes.
+    start: bytes
+        The beginning of the file if it was already received.
+    """
+    with open(path, "w+b") as f:
+        if not size:
+            return
+        allocate(f.fileno(), size)
+        with mmap(f.fileno(), size) as content, memoryview(content) as view:
+            start = start[:size]
+            view[: len(start)] = start
+            with view[len(start) :] as rest:
+                receive_exactly(sock, rest, DOWNLOAD_CHUNK_SIZE)
+
+
+def connect_to_peer(peer: str, request: bytes) -> socket:
+    """
+    Connects to a peer and sends it a request, inside the SYN if TCP Fast Open is used.
+
+    Parameters
+    ----------
+    peer: str
+        A string representing the IP address of the peer to connect to.
+    request: bytes
+        A byte object representing the framed request to send.
+
+    Returns
+    -------
+    peer_sock: socket
+        A socket representing the connection to the peer.
+    """
+    family, kind, proto, _, address = getaddrinfo(peer, 12010, type=SOCK_STREAM)[0]
+    peer_sock = socket(family, kind, proto)
+    try:
+        tune(peer_sock)
+        sent = 0
+        if MSG_FASTOPEN is not None:
+            try:
+                sent = peer_sock.sendto(request, MSG_FASTOPEN, address)
+            except OSError as error:
+                # Raised when TCP Fast Open is disabled for clients
+                if error.errno != EOPNOTSUPP:
+                    raise
+        if not sent:
+            peer_sock.connect(address)
+        peer_sock.sendall(request[sent:])
+    except BaseException:
+        peer_sock.close()
+        raise
+    return peer_sock
+
+
 def download_file(peer: str, file: str) -> bool:
     """
     Downloads a file from a peer and saves it to the local directory.
@@ -226,18 +656,28 @@ def download_file(peer: str, file: str) -> bool:
     True if the file was downloaded successfully, False otherwise.
     """
 
-    with create_connection((peer, 12010)) as peer_sock:
-        status, content = remote_call(peer_sock, b"GET_FILE " + file.encode()).split(
-            b" ", 1
-        )
+    request = frame(b"GET_FILE " + file.encode())
+    with connect_to_peer(peer, request) as peer_sock:
+        try:
+            reply, start = receive_reply(peer_sock)
+        except ConnectionError:
+            return False
+        status, size = reply.split(b" ", 1)
         if status == b"BAD":
             return False
-    with open(FOLDER + "/" + file, "wb") as f:
-        f.write(content)
-        return True
+        path = FOLDER + "/" + file
+        try:
+            receive_file(peer_sock, path, int(size), start)
+        except ConnectionError:
+            remove(path)
+            return False
+    LOCAL_FILES.add(file)
+    return True
 
 
 def main() -> None:
+    # Listen before the tracker can send other peers here
+    listen_for_peers()
     Thread(target=serve_peer_thread, daemon=True).start()
 
     tracker_sock = connect_to_tracker((TRACKER, 12000))
@@ -251,21 +691,24 @@ def main() -> None:
 
         if data == "ls":
             available_files = list_files(tracker_sock)
-    
+
+            if available_files is None:
+                print("The tracker could not list its files")
+                continue
+
             if not available_files:
                 print("No new files")
                 continue
 
             number_of_files = len(available_files)
 
-            indexes = [str(number) for number in range(number_of_files)]
-
-            for index, file in zip(indexes, available_files):
+            for index, file in enumerate(available_files):
                 print(f"{index}\t{file}")
 
             while True:
                 index = input("Index of the file to download> ")
-                if index not in indexes:
+                # Not isdigit, which accepts characters such as "²" that int rejects
+                if not (index.isdecimal() and int(index) < number_of_files):
                     print(f"Invalid index. Select a number between 0 and {number_of_files-1}")
                 else:
                     break
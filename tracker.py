@@ -1,140 +1,281 @@
 # Written by Samuel Sjøen
 # Based on skeleton code provided by Daniel Hernandez Escobar
 
-from collections import defaultdict
+from collections.abc import Callable
 from os import environ
-from random import choice
-from selectors import EVENT_READ, DefaultSelector
-from socket import create_server, socket
+from random import randrange
+from selectors import EVENT_READ, EVENT_WRITE, DefaultSelector
+from socket import (
+    IPPROTO_TCP,
+    TCP_NODELAY,
+    create_server,
+    socket,
+)
 
 TRACKER = environ.get("TRACKER", "localhost")
 
-tracker: defaultdict[bytes, set[str]] = defaultdict(set)
+CHUNK_SIZE = 65536
+# Largest message accepted, well above the size of a real ADD_MANY
+MAX_MESSAGE_SIZE = 4 << 20
+
+Peer = tuple[str, int]
+
+# The tracked files are kept as parallel lists, where file_index maps the name
+# of a file to its slot. The peers of a file are in a list so a random one can
+# be picked by index, and positions maps each peer to its index in that list.
+filenames: list[bytes] = []
+peerlists: list[list[Peer]] = []
+positions: list[dict[Peer, int]] = []
+file_index: dict[bytes, int] = {}
 selector = DefaultSelector()
 
+# The reply to LIST_FILES, None when the tracked files have changed since it was built
+listing: bytes | None = None
+
+
+class Connection:
+    """
+    Keeps the bytes received on a connection until a whole request has arrived,
+    and the replies still to be sent back on it.
+
+    Every message is framed as a 4-byte big-endian length followed by the payload.
+    """
+
+    def __init__(self, peer: Peer) -> None:
+        self.peer = peer
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.received = 0
+        self.outbuf = bytearray()
+
+    def receive(self, conn: socket) -> bool:
+        """Reads the available bytes from conn, returns False if it was closed."""
+        end = self.received + CHUNK_SIZE
+        n = conn.recv_into(memoryview(self.buffer)[self.received : end])
+        self.received += n
+        return n > 0
+
+    def requests(self) -> list[bytes]:
+        """
+        Returns the complete requests in the buffer and removes them from it.
+
+        Raises ConnectionError when a request is larger than MAX_MESSAGE_SIZE.
+        """
+        requests = []
+        start = 0
+        while self.received - start >= 4:
+            end = start + 4 + int.from_bytes(self.buffer[start : start + 4], "big")
+            if end > self.received:
+                break
+            requests.append(bytes(self.buffer[start + 4 : end]))
+            start = end
+        if start:
+            # Move the unfinished request to the front, unless it is already there
+            self.buffer[: self.received - start] = self.buffer[start : self.received]
+            self.received -= start
+            if self.received <= CHUNK_SIZE < len(self.buffer):
+                # Give back the room made for an earlier large request
+                del self.buffer[CHUNK_SIZE:]
+        if self.received >= 4:
+            # Make room for the rest of a request larger than the buffer
+            needed = 4 + int.from_bytes(self.buffer[:4], "big")
+            if needed > 4 + MAX_MESSAGE_SIZE:
+                raise ConnectionError("Message too large")
+            if needed > len(self.buffer):
+                self.buffer.extend(bytes(needed - len(self.buffer)))
+        return requests
+
+
+def frame(message: bytes) -> bytes:
+    """Prefixes a message with its length."""
+    return len(message).to_bytes(4, "big") + message
+
+
+def tune(sock: socket) -> None:
+    """
+    Disables Nagle's algorithm on a socket.
+
+    The kernel buffer sizes are left alone: setting them turns off Linux's
+    buffer autotuning, which grows them further than an explicit size can.
+    """
+    sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+
+def add_peer(peer: Peer, file: bytes) -> None:
+    """Adds a peer to a file"""
+
+    global listing
+    slot = file_index.get(file)
+    if slot is None:
+        slot = file_index[file] = len(filenames)
+        filenames.append(file)
+        peerlists.append([])
+        positions.append({})
+        listing = None
+    peers = peerlists[slot]
+    index = positions[slot]
+    if peer not in index:
+        index[peer] = len(peers)
+        peers.append(peer)
+    print(f"{file} has new peer: {peer}")
+
+
+def remove_peer(peer: Peer, file: bytes) -> bool:
+    """Removes a peer from a file, returns False if the peer did not have the file"""
+
+    global listing
+    slot = file_index.get(file)
+    if slot is None or peer not in positions[slot]:
+        return False
+    peers = peerlists[slot]
+    index = positions[slot]
+    # Move the last peer into the removed peer's place so the list stays dense
+    i = index.pop(peer)
+    last = peers.pop()
+    if last != peer:
+        peers[i] = last
+        index[last] = i
+    if not peers:
+        # Likewise move the last file into the slot of the file without peers
+        del file_index[file]
+        last_file = filenames.pop()
+        last_peers = peerlists.pop()
+        last_index = positions.pop()
+        if last_file != file:
+            filenames[slot] = last_file
+            peerlists[slot] = last_peers
+            positions[slot] = last_index
+            file_index[last_file] = slot
+        listing = None
+    print(f"{file} removed peer: {peer}")
+    return True
+
+
+def serve_add(peer: Peer, file: bytes) -> bytes:
+    """Adds the peer to a file"""
+
+    add_peer(peer, file)
+    return b"OK "
+
+
+def serve_add_many(peer: Peer, files: bytes) -> bytes:
+    """Adds the peer to every file in a list separated by slashes"""
+
+    # File names cannot contain a slash, so it cannot split a name in two
+    for file in files.split(b"/"):
+        if file:
+            add_peer(peer, file)
+    return b"OK "
+
+
+def serve_remove(peer: Peer, file: bytes) -> bytes:
+    """Removes the peer from a file"""
+
+    if remove_peer(peer, file):
+        return b"OK "
+    return b"BAD File does not exist"
+
+
+def serve_remove_many(peer: Peer, files: bytes) -> bytes:
+    """Removes the peer from every file in a list separated by slashes"""
 
-def serve(peer: str, data: bytes) -> bytes:
-    """Serves the peer depending on request"""
+    for file in files.split(b"/"):
+        if file:
+            remove_peer(peer, file)
+    return b"OK "
 
-    match data.split(b" ", 1):
-        case [b"ADD", file]:
-            tracker[file].add(peer)
-            reply = b"OK "
-            print(f"{file} has new peer: {peer}")
-        case [b"REMOVE", file]:
-            try:
-                tracker[file].remove(peer)
-            except ValueError:
-                reply = b"BAD File does not exist"
-            else:
-                reply = b"OK "
-                print(f"{file} removed peer: {peer}")
-        case [b"GET_PEER", file]:
-            if peer_set := tracker.get(file):
-                peer = choice(tuple(peer_set))
-                reply = b"OK " + str(peer[0]).encode()
-            else:
-                reply = b"BAD File does not exist"
-        case [b"LIST_FILES"]:
-            reply = b"OK " + b"; ".join(tracker)
-        case _:
-            reply = b"BAD Method not supported"
-    return reply
 
+def serve_get_peer(peer: Peer, file: bytes) -> bytes:
+    """Replies with the host of a random peer that has the file"""
 
-def read(conn: socket) -> None:
-    """Function where the decison is made to either serve or unregister the peer"""
+    if (slot := file_index.get(file)) is None:
+        return b"BAD File does not exist"
+    peers = peerlists[slot]
+    host, _ = peers[randrange(len(peers))]
+    return b"OK " + host.encode()
 
-    data = conn.recv(1024)
-    if data:
-        peer = conn.getpeername()
-        reply = serve(peer, data.strip())
-        conn.sendall(reply)
-    else:
-        selector.unregister(conn)
-        print(f"{conn.getpeername()} disconnected")
-        conn.close()
 
+def serve_list_files(peer: Peer, _: bytes) -> bytes:
+    """Replies with the names of all tracked files"""
 
-def accept(sock: socket) -> None:
-    """Function for accepting connections from peers"""
+    global listing
+    if listing is None:
+        listing = b"OK " + b"; ".join(filenames)
+        if len(listing) > MAX_MESSAGE_SIZE:
+            # Peers would drop a longer reply
+            listing = b"BAD Too many files to list"
+    return listing
+
+
+def serve_unsupported(peer: Peer, _: bytes) -> bytes:
+    """Replies to a request with an unknown method"""
 
-    conn, addr = sock.accept()
-    print(f"{addr} connected")
-    conn.setblocking(False)
-    selector.register(conn, EVENT_READ, read)
+    return b"BAD Method not supported"
 
 
-def main() -> None:
-    sock = create_server((TRACKER, 12000))
-    print("Tracker is online")
-    sock.setblocking(False)
-    selector.register(sock, EVENT_READ, accept)
+HANDLERS: dict[bytes, Callable[[Peer, bytes], bytes]] = {
+    b"ADD": serve_add,
+    b"ADD_MANY": serve_add_many,
+    b"REMOVE": serve_remove,
+    b"REMOVE_MANY": serve_remove_many,
+    b"GET_PEER": serve_get_peer,
+    b"LIST_FILES": serve_list_files,
+}
 
-    while True:
-        events = selector.select()
-        for key, _ in events:
-            key.data(key.fileobj)
 
+def serve(peer: Peer, data: bytes) -> bytes:
+    """Serves the peer depending on request"""
 
-if __name__ == "__main__":
-    main()
-# Written by Samuel Sjøen
-# Based on skeleton code provided by Daniel Hernandez Escobar
+    method, separator, argument = data.partition(b" ")
+    # LIST_FILES takes no argument, and every other method needs a non-empty one
+    if (method == b"LIST_FILES" and separator) or (
+        method != b"LIST_FILES" and not argument
+    ):
+        return serve_unsupported(peer, argument)
+    return HANDLERS.get(method, serve_unsupported)(peer, argument)
 
-from collections import defaultdict
-from os import environ
-from random import choice
-from selectors import EVENT_READ, DefaultSelector
-from socket import create_server, socket
 
-TRACKER = environ.get("TRACKER", "localhost")
+def read(conn: socket, state: Connection) -> None:
+    """Function where the decison is made to either serve or unregister the peer"""
 
-tracker: defaultdict[bytes, set[str]] = defaultdict(set)
-selector = DefaultSelector()
+    try:
+        received = state.receive(conn)
+        requests = state.requests() if received else []
+    except BlockingIOError:
+        return
+    except OSError:
+        received = False
+    if received:
+        for request in requests:
+            state.outbuf += frame(serve(state.peer, request))
+        write(conn, state)
+    else:
+        disconnect(conn, state)
 
 
-def serve(peer: str, data: bytes) -> bytes:
-    """Serves the peer depending on request"""
+def write(conn: socket, state: Connection) -> None:
+    """Function for sending as much of the queued replies as the socket accepts"""
 
-    match data.split(b" ", 1):
-        case [b"ADD", file]:
-            tracker[file].add(peer)
-            reply = b"OK "
-            print(f"{file} has new peer: {peer}")
-        case [b"REMOVE", file]:
-            try:
-                tracker[file].remove(peer)
-            except ValueError:
-                reply = b"BAD File does not exist"
-            else:
-                reply = b"OK "
-                print(f"{file} removed peer: {peer}")
-        case [b"GET_PEER", file]:
-            if peer_set := tracker.get(file):
-                peer = choice(tuple(peer_set))
-                reply = b"OK " + str(peer[0]).encode()
-            else:
-                reply = b"BAD File does not exist"
-        case [b"LIST_FILES"]:
-            reply = b"OK " + b"; ".join(tracker)
-        case _:
-            reply = b"BAD Method not supported"
-    return reply
+    try:
+        while state.outbuf:
+            sent = conn.send(state.outbuf)
+            del state.outbuf[:sent]
+    except BlockingIOError:
+        pass
+    except OSError:
+        disconnect(conn, state)
+        return
+    # Only wait for the socket to become writable while replies are queued
+    events = EVENT_READ | EVENT_WRITE if state.outbuf else EVENT_READ
+    if selector.get_key(conn).events != events:
+        selector.modify(conn, events, state)
 
 
-def read(conn: socket) -> None:
-    """Function where the decison is made to either serve or unregister the peer"""
+def disconnect(conn: socket, state: Connection) -> None:
+    """Function for unregistering a peer and closing its connection"""
 
-    data = conn.recv(1024)
-    if data:
-        peer = conn.getpeername()
-        reply = serve(peer, data.strip())
-        conn.sendall(reply)
-    else:
-        selector.unregister(conn)
-        print(f"{conn.getpeername()} disconnected")
-        conn.close()
+    selector.unregister(conn)
+    print(f"{state.peer} disconnected")
+    conn.close()
 
 
 def accept(sock: socket) -> None:
@@ -142,21 +283,29 @@ def accept(sock: socket) -> None:
 
     conn, addr = sock.accept()
     print(f"{addr} connected")
+    tune(conn)
     conn.setblocking(False)
-    selector.register(conn, EVENT_READ, read)
+    selector.register(conn, EVENT_READ, Connection(addr))
 
 
 def main() -> None:
     sock = create_server((TRACKER, 12000))
+    tune(sock)
     print("Tracker is online")
     sock.setblocking(False)
-    selector.register(sock, EVENT_READ, accept)
+    selector.register(sock, EVENT_READ)
 
     while True:
         events = selector.select()
-        for key, _ in events:
-            key.data(key.fileobj)
+        for key, mask in events:
+            if key.data is None:
+                accept(key.fileobj)
+            elif mask & EVENT_READ:
+                # Also sends whatever the new requests queued
+                read(key.fileobj, key.data)
+            else:
+                write(key.fileobj, key.data)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()